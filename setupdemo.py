@@ -1,17 +1,59 @@
+import copy
+import functools
+import json
 import logging
+import os
 from pathlib import Path
-from uuid import uuid4
-from logging import info, root, warning, error
+import secrets
 import argparse
 
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    # libyaml not available, fall back to the pure python implementation
+    from yaml import SafeLoader, SafeDumper
+
+log = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_skeleton(path):
+    """Loads a skeleton config file, parsing every file only once
+
+    Args:
+        path (str): location of the skeleton yaml file
+
+    Returns:
+        dict: the parsed skeleton, must not be modified by callers
+    """
+    with open(path) as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+
+def _write_file(path, text):
+    """Writes text to a file in one go, without python's buffered file objects
+
+    Args:
+        path (Path): the file to (over)write
+        text (str): the full contents of the file
+    """
+    data = text.encode('utf-8')
+    # like open(), leave the permissions of new files up to the umask
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        # os.write may write less than asked for, keep going until done
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
 
 
 class DemoCreator:
     """Creates a demo based on names, databases, and some paths
     """
     
-    def __init__(self, database_dir=Path('databases'), names=[], root_dir=Path('.'), infra_config=Path('v6-demo-infra.yaml'), clean=False, **kwargs):
+    def __init__(self, database_dir=Path('databases'), names=[], root_dir=Path('.'), infra_config=Path('v6-demo-infra.json'), clean=False, **kwargs):
         """Initializes the demo creator - does not generate anything
 
         Args:
@@ -22,30 +64,34 @@ class DemoCreator:
         self.orgs = []
         self.server = {}
 
+        # infrastructure files used to be written as yaml, fall back to those
+        legacy_config = infra_config.with_suffix('.yaml')
+        if not infra_config.exists() and infra_config.suffix == '.json' and legacy_config.exists():
+            log.info('no %s found, using old infrastructure file %s', infra_config, legacy_config)
+            infra_config = legacy_config
+
         # if there is an existing infrastructure file
         if infra_config.exists() and not clean:
-            info('found existing infrastructure file, using it')
-            with open(infra_config, 'r') as f:
-                config = yaml.safe_load(f)
-
-            for key in ['config_loc', 'yaml_loc']:
-                if key in config['server']:
-                    path = Path(config['server'][key])
-                    if path.exists():
-                        config['server'][key] = path
-                    else:
-                        config['server'].pop(key, None)
-                        warning(f'path {path} not found, this will have to be regenerated')
-
-            for key in ['node_config', 'database']:
-                for org in config['orgs']:
-                    if key in org:
-                        path = Path(org[key])
-                        if path.exists():
-                            org[key] = path
-                        else:
-                            org.pop(key, None)
-                            warning(f'path {path} not found, this will have to be regenerated')
+            log.info('found existing infrastructure file, using it')
+            # both parsers take the raw bytes, no need to decode them first
+            data = infra_config.read_bytes()
+            if infra_config.suffix == '.json':
+                config = json.loads(data)
+            else:
+                config = yaml.load(data, Loader=SafeLoader)
+
+            # collect every stored path in one pass, as (owner, key, path)
+            owners = [(config['server'], ['config_loc', 'yaml_loc'])]
+            owners += [(org, ['node_config', 'database']) for org in config['orgs']]
+            locations = [(owner, key, Path(owner[key]))
+                         for owner, keys in owners for key in keys if key in owner]
+
+            for owner, key, path in locations:
+                if path.exists():
+                    owner[key] = path.resolve()
+                else:
+                    owner.pop(key, None)
+                    log.warning('path %s not found, this will have to be regenerated', path)
 
             self.orgs = config['orgs']
             self.server = config['server']
@@ -53,53 +99,57 @@ class DemoCreator:
 
         self.root_dir = root_dir
         
-        databases = [db for db in database_dir.glob('*.csv') if db.is_file()]
+        # scandir entries carry the file type, saving a stat call per file
+        databases = []
+        if database_dir.is_dir():
+            with os.scandir(database_dir) as entries:
+                databases = [Path(entry.path) for entry in entries
+                             if entry.name.endswith('.csv') and entry.is_file()]
 
         if not self.orgs:
             if not names:
-                info('no names provided, generating them from database names')
+                log.info('no names provided, generating them from database names')
                 self.orgs = [ {'name': db.stem} for db in databases ]
             else:
                 self.orgs = [ {'name': name} for name in names]
 
-        if any(['database' not in org for org in self.orgs]):
+        if databases and any('database' not in org for org in self.orgs):
             # If there are more names than databases, recycle databases
             if len(self.orgs) > len(databases):
-                info('more names than databases provided, re-using databases')
-                databases = [databases[i % len(databases)] for i in range(len(self.orgs))]
+                log.info('more names than databases provided, re-using databases')
 
-            for i in range(len(self.orgs)):
-                self.orgs[i]['database'] = databases[i]
+            for i, org in enumerate(self.orgs):
+                org.setdefault('database', databases[i % len(databases)])
 
     def generate_api_keys(self):
         if self.orgs:
-            info('generating API keys')
+            log.info('generating API keys')
             for org in self.orgs:
-                org.setdefault('api_key', str(uuid4()))
+                org.setdefault('api_key', secrets.token_hex(16))
         else:
-            error('no names or database provided, cannot determine number of API keys')
+            log.error('no names or database provided, cannot determine number of API keys')
             return
 
     def generate_users(self):
         if self.orgs:
-            info('generating users')
+            log.info('generating users')
             for org in self.orgs:
                 org.setdefault('username', f'{org["name"]}-user')
                 org.setdefault('password', f'{org["name"]}-demo-password')
         else:
-            error('no names or database provided, cannot determine number of users')
+            log.error('no names or database provided, cannot determine number of users')
             return
 
     def generate_entities_yaml(self):
         if not self.orgs:
-            warning('no names or database provided, can only add empty collaboration')
+            log.warning('no names or database provided, can only add empty collaboration')
 
-        if any(['api_key' not in org for org in self.orgs]):
-            info('no API keys generated yet, generating')
+        if any('api_key' not in org for org in self.orgs):
+            log.info('no API keys generated yet, generating')
             self.generate_api_keys()
 
-        if any(['username' not in org for org in self.orgs]):
-            info('no users generated yet, generating')
+        if any('username' not in org for org in self.orgs):
+            log.info('no users generated yet, generating')
             self.generate_users()
 
         entity_yaml = {
@@ -150,65 +200,77 @@ class DemoCreator:
         yaml_dir = self.root_dir / 'v6_files/server/'
         yaml_dir.mkdir(parents=True, exist_ok=True)
 
-        self.server['yaml_loc'] = yaml_dir / "entities.yaml"
+        self.server['yaml_loc'] = (yaml_dir / "entities.yaml").resolve()
 
-        info(f'writing yaml to {self.server["yaml_loc"]}')
+        log.info('writing yaml to %s', self.server['yaml_loc'])
 
-        with open(self.server['yaml_loc'], 'w') as f:
-            yaml.safe_dump(entity_yaml, f)
+        _write_file(self.server['yaml_loc'], yaml.dump(entity_yaml, Dumper=SafeDumper))
 
     def generate_server_config(self):
-        with open(self.root_dir / 'skeletons/server-config-skeleton.yaml') as f:
-            server_config = yaml.safe_load(f)
+        server_config = copy.deepcopy(
+            _load_skeleton(str(self.root_dir / 'skeletons/server-config-skeleton.yaml')))
 
         # In the future maybe do something with config
 
         # make sure output dir exists
         config_path = self.root_dir / 'v6_files/server'
         config_path.mkdir(parents=True, exist_ok=True)
-        self.server['config_loc'] = config_path / 'config.yaml'
-        with open(self.server['config_loc'], 'w') as f:
-            info(f'writing server config to {self.server["config_loc"]}')
-            yaml.safe_dump(server_config, f)
+        self.server['config_loc'] = (config_path / 'config.yaml').resolve()
+        log.info('writing server config to %s', self.server['config_loc'])
+        _write_file(self.server['config_loc'], yaml.dump(server_config, Dumper=SafeDumper))
 
     def generate_node_configs(self):
         if not self.orgs:
-            error('no names or database provided, cannot generate node configs')
+            log.error('no names or database provided, cannot generate node configs')
             return
 
-        if any(['database' not in org for org in self.orgs]):
-            warning('no databases provided, these will have to be added in the config manually')
+        if any('database' not in org for org in self.orgs):
+            log.warning('no databases provided, these will have to be added in the config manually')
 
-        if any(['api_key' not in org for org in self.orgs]):
-            info('no API keys generated yet, generating')
+        if any('api_key' not in org for org in self.orgs):
+            log.info('no API keys generated yet, generating')
             self.generate_api_keys()
         
         # Create node config
         config_dir = self.root_dir / f'v6_files/'
         config_dir.mkdir(parents=True, exist_ok=True)
+        # resolve the directory once instead of every config file in it
+        config_dir = config_dir.resolve()
 
-        with open(self.root_dir / 'skeletons/node-config-skeleton.yaml') as f:
-            node_skeleton = yaml.safe_load(f)
+        node_skeleton = _load_skeleton(str(self.root_dir / 'skeletons/node-config-skeleton.yaml'))
 
         # self.node_configs = [config_dir / f'{name}.yaml' for name in self.names]   
 
         for org in self.orgs:
             config = config_dir / f'{org["name"]}.yaml'
             org['node_config'] = config
+            if 'database' in org:
+                org['database'] = org['database'].resolve()
+
+            # Only copy the parts of the skeleton that are filled in, the rest
+            # is shared between nodes and only read when dumping
+            application = node_skeleton['application']
+            node = {
+                **node_skeleton,
+                'application': {
+                    **application,
+                    'databases': {
+                        **application['databases'],
+                        # left empty for the user to fill in when there is no database
+                        'default': str(org['database']) if 'database' in org else None
+                    },
+                    'api_key': org['api_key'],
+                    # Enable encryption
+                    'encryption': {
+                        **application['encryption'],
+                        'enabled': False,
+                        'private_key': ''
+                    }
+                }
+            }
 
-            node = node_skeleton.copy()
-
-            node['application']['databases']['default'] = str(org['database'].resolve())
-
-            node['application']['api_key'] = org['api_key']
-
-            # Enable encryption
-            node['application']['encryption']['enabled'] = False
-            node['application']['encryption']['private_key'] = ''
-
-            info(f'writing node config file to {config}')
-            with open(config, 'w+') as f:
-                yaml.safe_dump(node, f)
+            log.info('writing node config file to %s', config)
+            _write_file(config, yaml.dump(node, Dumper=SafeDumper))
 
     def print_all(self):
         """Print out all the important info for whatever details have been generated
@@ -216,11 +278,11 @@ class DemoCreator:
         print('########## Server ##########')
         if 'config_loc' in self.server:
             print(f'Config file: {self.server["config_loc"]}')
-            print(f'Run command: vserver start --user -c {self.server["config_loc"].resolve()}')
+            print(f'Run command: vserver start --user -c {self.server["config_loc"]}')
 
         if 'yaml_loc' in self.server:
             print(f'Entities yaml: {self.server["yaml_loc"]}')
-            print(f'Import command: vserver import --user --drop-all -c {self.server["config_loc"].resolve()} {self.server["yaml_loc"].resolve()}')
+            print(f'Import command: vserver import --user --drop-all -c {self.server["config_loc"]} {self.server["yaml_loc"]}')
 
         print()
 
@@ -232,7 +294,7 @@ class DemoCreator:
                 print(f'Database: {org["database"]}')
             if 'node_config' in org:
                 print(f'Config file: {org["node_config"]}')
-                print(f'Run command: vnode start -c {org["node_config"].resolve()}')
+                print(f'Run command: vnode start -c {org["node_config"]}')
 
             print()
 
@@ -240,13 +302,13 @@ class DemoCreator:
         """Print out the run commands for any nodes and server that has been generated
         """
         if 'config_loc' in self.server:
-            print(f'vserver start --user -c {self.server["config_loc"].resolve()}')
+            print(f'vserver start --user -c {self.server["config_loc"]}')
         if 'yaml_loc' in self.server:
-            print(f'vserver import --user --drop-all -c {self.server["config_loc"].resolve()} {self.server["yaml_loc"].resolve()}')
+            print(f'vserver import --user --drop-all -c {self.server["config_loc"]} {self.server["yaml_loc"]}')
 
         for org in self.orgs:
             if 'node_config' in org:
-                print(f'vnode start -c {org["node_config"].resolve()}')
+                print(f'vnode start -c {org["node_config"]}')
 
     def write_demo_infra(self):
         config = {
@@ -263,10 +325,9 @@ class DemoCreator:
                 if key in org:
                     org[key] = str(org[key])
 
-        write_loc = self.root_dir / "v6-demo-infra.yaml"
-        info(f'writing infrastructure config to {write_loc}')
-        with open(write_loc, 'w') as f:
-            yaml.safe_dump(config, f)
+        write_loc = self.root_dir / "v6-demo-infra.json"
+        log.info('writing infrastructure config to %s', write_loc)
+        _write_file(write_loc, json.dumps(config, indent=2))
 
         
 
@@ -281,9 +342,9 @@ if __name__ == '__main__':
                         When no names are provided, the organizations will be named
                         after the database files provided (if any).''', 
                         default=[])
-    parser.add_argument('--infra-config', type=Path, nargs=1,
+    parser.add_argument('--infra-config', type=Path,
                         help='what existing infrastructure file (if any) should be used?',
-                        default='./v6-demo-infra.yaml')
+                        default='./v6-demo-infra.json')
     parser.add_argument('--clean', '-c', action='store_true',
                         help='ignore any existing infrastructure files and start clean')
     parser.add_argument('--verbose', '-v', action='store_true')
@@ -299,6 +360,8 @@ if __name__ == '__main__':
 
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.WARNING)
     
     dc = DemoCreator(**vars(args))
 